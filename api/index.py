@@ -1,30 +1,322 @@
-from flask import Flask, request, jsonify
+import functools
+import os
+import re
+import time
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import diskcache
+import httpx
+import orjson
+from flask import Flask, Response, request, jsonify, stream_with_context
 from apify_client import ApifyClient
+from apify_client._errors import ApifyApiError
+from cachetools import TTLCache
 from flask_cors import CORS
 from vercel_proxy import VercelProxy  # Required for Vercel support
+from werkzeug.exceptions import HTTPException
 
 app = Flask(__name__)
 CORS(app)
 VercelProxy(app)  # 👈 Add this line
 
-apify_client = ApifyClient("apify_api_ByzOzUbcyNjiI163g5rKzHxWbbtDQs0mYnDa")
+# One client for the whole process: its underlying HTTP session keeps
+# connections to api.apify.com alive across requests in a warm instance.
+# Built lazily on first use so importing the module does not require the
+# token (set APIFY_TOKEN in the Vercel environment).
+@functools.cache
+def _apify_client() -> ApifyClient:
+    return ApifyClient(
+        os.environ['APIFY_TOKEN'],
+        max_retries=2,
+        min_delay_between_retries_millis=200,
+        timeout_secs=60,
+    )
+
+# How long a cached transcript stays servable, measured from the write
+# that fetched it — not from any later promotion between tiers.
+_CACHE_TTL = 3600
+
+# Transcript results keyed by video_id. Repeat requests for the same video
+# skip the Apify actor run entirely and answer from memory.
+transcript_cache = TTLCache(maxsize=2000, ttl=_CACHE_TTL)
+
+# Second cache tier on /tmp, which Vercel keeps across warm invocations
+# of the same lambda: a fresh process can still answer repeat videos
+# without re-running the actor. Sized well under Vercel's 500 MB /tmp.
+disk_cache = diskcache.Cache('/tmp/khcache', size_limit=200 * 1024 * 1024)
+
+
+def _cache_get(video_id):
+    record = transcript_cache.get(video_id)
+    if record is None:
+        raw = disk_cache.get(video_id)
+        if raw is None:
+            return None
+        record = orjson.loads(raw)
+        transcript_cache[video_id] = record
+    # The saved_at stamp enforces the freshness bound across both tiers;
+    # promoting a disk hit into memory must not restart the clock.
+    if time.time() - record['saved_at'] >= _CACHE_TTL:
+        transcript_cache.pop(video_id, None)
+        return None
+    return record['entry']
+
+
+def _cache_set(video_id, entry):
+    record = {'saved_at': time.time(), 'entry': entry}
+    transcript_cache[video_id] = record
+    disk_cache.set(video_id, orjson.dumps(record), expire=_CACHE_TTL)
+
+_ACTOR_ID = "fastcrawler/youtube-transcript-extractor-video-text-3-1k-pay-per-result"
+
+# Run statuses after which an actor run will never produce more data.
+_TERMINAL_STATUSES = frozenset({'SUCCEEDED', 'FAILED', 'ABORTED', 'TIMED-OUT'})
+
+_YT_ID_RE = re.compile(
+    r'(?:youtube(?:-nocookie)?\.com/(?:watch\?(?:.*&)?v=|embed/|v/|shorts/)'
+    r'|youtu\.be/)([A-Za-z0-9_-]{11})'
+)
+
+
+class ActorRunError(Exception):
+    # An actor run ended (or timed out) without producing a complete
+    # transcript; http_status picks the response code for the client.
+    def __init__(self, message, http_status):
+        super().__init__(message)
+        self.http_status = http_status
+
+
+def extract_video_id(url: str) -> Optional[str]:
+    # Fast path: parse the common URL shapes directly instead of running
+    # the regex. Unknown shapes fall back to the precompiled pattern.
+    parsed = urlparse(url)
+    hostname = parsed.hostname or ''
+    if hostname.endswith('youtu.be'):
+        video_id = parsed.path.lstrip('/')[:11]
+        return video_id or None
+    if hostname.endswith(('youtube.com', 'youtube-nocookie.com')):
+        if parsed.path == '/watch':
+            return parse_qs(parsed.query).get('v', [None])[0]
+        if parsed.path.startswith(('/embed/', '/v/', '/shorts/')):
+            return parsed.path.split('/')[2][:11] or None
+    match = _YT_ID_RE.search(url)
+    return match.group(1) if match else None
+
+
+def _item_video_id(item: dict) -> Optional[str]:
+    # Dataset items carry the source video in a url- or id-shaped field;
+    # check the common names so results can be grouped per input video.
+    for key in ('url', 'videoUrl', 'video_url', 'originalUrl'):
+        value = item.get(key)
+        if isinstance(value, str):
+            video_id = extract_video_id(value)
+            if video_id:
+                return video_id
+    for key in ('videoId', 'video_id', 'id'):
+        value = item.get(key)
+        if isinstance(value, str) and len(value) == 11:
+            return value
+    return None
+
+
+def _wait_for_run(run_id, timeout_secs=60):
+    # Poll with exponential backoff (1s, 2s, 4s, capped at 8s) instead of
+    # the client's fixed short interval, halving Apify API call volume
+    # for typical 5-30 s transcript runs.
+    run_client = _apify_client().run(run_id)
+    deadline = time.monotonic() + timeout_secs
+    delay = 1.0
+    while True:
+        remaining = deadline - time.monotonic()
+        wait_secs = int(max(1.0, min(delay, remaining)))
+        run = run_client.wait_for_finish(wait_secs=wait_secs)
+        if run is None or run['status'] in _TERMINAL_STATUSES:
+            return run
+        if remaining <= 0:
+            return run
+        delay = min(delay * 2, 8.0)
+
+
+def _run_actor(urls):
+    client = _apify_client()
+    run = client.actor(_ACTOR_ID).start(run_input={"urls": urls})
+    run = _wait_for_run(run['id']) or run
+    status = run['status']
+    if status != 'SUCCEEDED':
+        # Never read the dataset of an unfinished or failed run: it holds
+        # a partial (often empty) transcript that would go out as a 200.
+        if status in _TERMINAL_STATUSES:
+            raise ActorRunError(f'Actor run ended with status {status}', 502)
+        raise ActorRunError('Actor run did not finish in time', 504)
+    dataset_id = run["defaultDatasetId"]
+    return dataset_id, _dataset_items(dataset_id)
+
+
+def _json_response(payload, status=200):
+    # orjson serializes the transcript item lists several times faster
+    # than the stdlib encoder behind jsonify. Error paths keep jsonify.
+    return Response(orjson.dumps(payload), status=status,
+                    mimetype='application/json')
+
+
+def _handle_upstream_errors(view):
+    # Single source of truth for mapping upstream failures to responses:
+    # timeouts -> 504, Apify API errors -> 502, anything else -> 500.
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        except httpx.TimeoutException:
+            return jsonify({'error': 'Upstream request timed out'}), 504
+        except ActorRunError as e:
+            return jsonify({'error': str(e)}), e.http_status
+        except ApifyApiError as e:
+            return jsonify({'error': str(e)}), 502
+        except HTTPException:
+            # Request-parsing errors from get_json() (400/415 etc.) are
+            # client errors; let Flask render them, not the 500 branch.
+            raise
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+    return wrapper
+
+
+def _dataset_items(dataset_id):
+    return _apify_client().dataset(dataset_id).iterate_items()
+
+
+_NO_ITEM = object()
+
+
+def _stream_transcript(dataset_id, items, video_id):
+    # Emit the JSON body piece by piece while reading dataset items, so
+    # the first bytes leave as soon as the first item arrives and the
+    # whole document is never held in memory twice. The items are still
+    # collected along the way so the finished result lands in the cache.
+    # The first item is fetched eagerly, before the Response exists: an
+    # upstream failure here still propagates to _handle_upstream_errors
+    # instead of truncating an already-started 200 stream.
+    items = iter(items)
+    first = next(items, _NO_ITEM)
+
+    def generate():
+        yield b'{"dataset_id":' + orjson.dumps(dataset_id) + b',"transcript":['
+        collected = []
+        if first is not _NO_ITEM:
+            yield orjson.dumps(first)
+            collected.append(first)
+        for item in items:
+            yield b',' + orjson.dumps(item)
+            collected.append(item)
+        yield b']}'
+        # Like the batch path, never cache an empty result: one transient
+        # actor hiccup must not poison the video id for a whole TTL.
+        if video_id and collected:
+            _cache_set(video_id, {
+                "dataset_id": dataset_id,
+                "transcript": collected
+            })
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 
 @app.route('/transcript', methods=['POST'])
+@_handle_upstream_errors
 def get_transcript():
     data = request.get_json()
-    if not data or 'url' not in data:
+    if not data or ('url' not in data and 'urls' not in data):
         return jsonify({'error': 'Missing YouTube video URL'}), 400
 
-    try:
-        video_url = data['url']
-        run_input = {"urls": [video_url]}
-        run = apify_client.actor("fastcrawler/youtube-transcript-extractor-video-text-3-1k-pay-per-result").call(run_input=run_input)
-        dataset_id = run["defaultDatasetId"]
-        results = list(apify_client.dataset(dataset_id).iterate_items())
+    urls = data.get('urls')
+    if 'urls' in data and (not isinstance(urls, list) or not urls):
+        return jsonify({'error': 'urls must be a non-empty list'}), 400
+
+    if data.get('async'):
+        run_urls = urls if urls is not None else [data['url']]
+        run = _apify_client().actor(_ACTOR_ID).start(run_input={"urls": run_urls})
+        return _json_response({
+            "run_id": run['id'],
+            "status": run['status'],
+            "status_url": f"/transcript/status/{run['id']}"
+        }, status=202)
+
+    refresh = request.args.get('refresh') == '1' or data.get('refresh')
+
+    if urls is not None:
+        return _json_response(_get_transcripts_batch(urls, refresh))
 
-        return jsonify({
+    video_url = data['url']
+    video_id = extract_video_id(video_url)
+
+    if video_id and not refresh:
+        cached = _cache_get(video_id)
+        if cached is not None:
+            return _json_response(cached)
+
+    dataset_id, items = _run_actor([video_url])
+    return _stream_transcript(dataset_id, items, video_id)
+
+
+def _get_transcripts_batch(urls, refresh):
+    # Serve what we can from the cache, then fetch every remaining video
+    # in a single actor run instead of one run per URL.
+    video_ids = [extract_video_id(url) for url in urls]
+    results = [None] * len(urls)
+    errors = []
+
+    pending = []
+    for index, (url, video_id) in enumerate(zip(urls, video_ids)):
+        cached = _cache_get(video_id) if video_id and not refresh else None
+        if cached is not None:
+            results[index] = cached
+        else:
+            pending.append(index)
+
+    if pending:
+        dataset_id, items = _run_actor([urls[i] for i in pending])
+        items = list(items)
+        grouped = {}
+        for item in items:
+            grouped.setdefault(_item_video_id(item), []).append(item)
+        for index in pending:
+            video_id = video_ids[index]
+            # No id for this URL means no lookup: the None bucket holds
+            # items whose video could not be identified, not this URL's.
+            matched = grouped.get(video_id) if video_id else None
+            if matched is None and len(pending) == 1:
+                # Single fetch: the run can only be about this video.
+                matched = items
+            if matched:
+                entry = {"dataset_id": dataset_id, "transcript": matched}
+                results[index] = entry
+                if video_id:
+                    _cache_set(video_id, entry)
+            else:
+                errors.append({"index": index, "url": urls[index],
+                               "error": "No transcript data returned"})
+
+    return {"results": results, "errors": errors}
+
+
+@app.route('/transcript/status/<run_id>', methods=['GET'])
+@_handle_upstream_errors
+def get_transcript_status(run_id):
+    run = _apify_client().run(run_id).get()
+    if run is None:
+        return jsonify({'error': 'Run not found'}), 404
+    status = run['status']
+    if status == 'SUCCEEDED':
+        dataset_id = run['defaultDatasetId']
+        return _json_response({
+            "status": status,
             "dataset_id": dataset_id,
-            "transcript": results
+            "transcript": list(_dataset_items(dataset_id))
         })
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return _json_response({"run_id": run_id, "status": status})
+
+
+@app.route('/api/cache/clear', methods=['POST'])
+def clear_cache():
+    transcript_cache.clear()
+    disk_cache.clear()
+    return _json_response({'success': True})